@@ -1,151 +1,392 @@
 #!/usr/bin/env python3
 
 import argparse
+import gzip
+import json
+import os
 import re
 import sys
+import urllib.error
 import urllib.request
-import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from html import unescape
+from typing import BinaryIO, Iterator
+
+try:
+    # libxml2-backed parser; used when installed
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+try:
+    # Pooled keep-alive connections; urllib opens a new TLS connection per request
+    import urllib3
+except ImportError:
+    urllib3 = None
 
 SOURCE_FEED_URL = "https://nhkeasier.com/feed/"
 BASE_URL = "https://nhkeasier.com"
 BITRATE_BPS = 192000  # 192 kbps
+MAX_WORKERS = 16  # Concurrent HEAD requests for MP3 sizes
+SIZE_CACHE_PATH = os.path.expanduser("~/.cache/nhk-easy-podcast/sizes.json")
+SIZE_CACHE_MAX_ENTRIES = 1000
+FEED_CHUNK_SIZE = 64 * 1024
+CHANNEL_DEPTH = 2  # rss > channel
+ITEM_DEPTH = 3  # rss > channel > item
+REQUEST_TIMEOUT = 30
+FEED_HEADERS = {'Accept-Encoding': 'gzip'}  # XML compresses well
+
+MP3_URL_RE = re.compile(r'<audio[^>]+src=["\']?([^"\'>\s]+\.mp3)', re.IGNORECASE)
+RELATIVE_URL_RE = re.compile(r'(src|href)=["\']/(?!/)([^"\']+)["\']')
+RELATIVE_URL_REPLACEMENT = rf'\1="{BASE_URL}/\2"'
+DUPLICATE_ITUNES_NS_RE = re.compile(r'(\s+xmlns:itunes="[^"]*")(\s+xmlns:itunes="[^"]*")+')
 
 NAMESPACES = {
     'itunes': 'http://www.itunes.com/dtds/podcast-1.0.dtd',
     'atom': 'http://www.w3.org/2005/Atom'
 }
 
-def fetch_feed(url: str) -> str:
-    with urllib.request.urlopen(url, timeout=30) as response:
-        return response.read().decode('utf-8')
+# Clark-notation tag names, built once rather than per item
+ITUNES = f"{{{NAMESPACES['itunes']}}}"
+ITUNES_AUTHOR = ITUNES + 'author'
+ITUNES_SUMMARY = ITUNES + 'summary'
+ITUNES_EXPLICIT = ITUNES + 'explicit'
+ITUNES_CATEGORY = ITUNES + 'category'
+ITUNES_DURATION = ITUNES + 'duration'
+
+HTTP = urllib3.PoolManager(
+    maxsize=MAX_WORKERS,
+    retries=urllib3.Retry(connect=1, read=1, redirect=5)
+) if urllib3 else None
+
+def raise_for_status(url: str, response) -> None:
+    """Mirrors urlopen by raising HTTPError for error responses from the pool."""
+    if response.status >= 400:
+        response.release_conn()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+def fetch_headers(url: str, method: str = 'GET', headers: dict[str, str] | None = None):
+    """Sends a request and returns only its response headers."""
+    if HTTP is None:
+        request = urllib.request.Request(url, headers=headers or {}, method=method)
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return response.headers
+
+    # Only HEAD bodies are safe to preload: a server that ignores Range would
+    # otherwise send the whole MP3
+    response = HTTP.request(method, url, headers=headers, timeout=REQUEST_TIMEOUT,
+                            preload_content=method == 'HEAD')
+    raise_for_status(url, response)
+    if method != 'HEAD':
+        # Closing drops the connection rather than draining a possibly large body
+        response.close()
+    return response.headers
+
+@contextmanager
+def fetch_feed(url: str) -> Iterator[BinaryIO]:
+    """Opens the feed as a decompressed byte stream, closing it on exit."""
+    if HTTP is None:
+        request = urllib.request.Request(url, headers=FEED_HEADERS)
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            if response.headers.get('Content-Encoding') == 'gzip':
+                with gzip.GzipFile(fileobj=response) as stream:
+                    yield stream
+            else:
+                yield response
+        return
+
+    # urllib3 decodes gzip transparently while streaming (decode_content defaults to True)
+    response = HTTP.request('GET', url, headers=FEED_HEADERS, timeout=REQUEST_TIMEOUT,
+                            preload_content=False)
+    raise_for_status(url, response)
+    with response:
+        yield response
+
+def read_feed_chunks(source: BinaryIO) -> Iterator[bytes]:
+    """Yields the raw feed in chunks with duplicate namespace declarations removed."""
+    head = b''
+    while b'<channel' not in head:
+        chunk = source.read(FEED_CHUNK_SIZE)
+        if not chunk:
+            break
+        head += chunk
+
+    # The root <rss> tag closes before <channel>, so only the head is cleaned.
+    # Unlike a whole-document pass, a duplicate declaration on <channel> or an
+    # <item> is left in place and will fail to parse.
+    split = head.find(b'<channel')
+    if split < 0:
+        split = len(head)
+    prolog, head = head[:split], head[split:]
+    # Feeds almost never repeat the declaration; a bytes count is far cheaper than the regex
+    if prolog.count(b'xmlns:itunes=') > 1:
+        prolog = DUPLICATE_ITUNES_NS_RE.sub(r'\1', prolog.decode('utf-8')).encode('utf-8')
+    yield prolog
+    yield head
+
+    while chunk := source.read(FEED_CHUNK_SIZE):
+        yield chunk
+
+def iter_feed_events(source: BinaryIO) -> Iterator[tuple[str, ET.Element]]:
+    """Incrementally parses the feed, yielding (event, element) pairs."""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    for chunk in read_feed_chunks(source):
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def find_audio_src(html_content: str) -> str | None:
+    """Slices the MP3 src out of the first <audio> tag without the regex engine."""
+    start = html_content.find('<audio')
+    if start < 0:
+        return None
+    end = html_content.find('>', start)
+    if end < 0:
+        end = len(html_content)
+
+    src = html_content.rfind('src=', start, end)
+    if src < 0:
+        return None
+    src += 4
+    quote = html_content[src:src + 1]
+    if quote in ('"', "'"):
+        src += 1
+        stop = html_content.find(quote, src, end)
+    else:
+        stop = html_content.find(' ', src, end)
+    value = html_content[src:stop if stop >= 0 else end]
+
+    mp3_end = value.rfind('.mp3')
+    if mp3_end < 0:
+        return None
+    value = value[:mp3_end + 4]
+    # Entity-quoted or otherwise unusual values are left to the regex fallback
+    if '&' in value or not (value[0].isalnum() or value[0] in '/.'):
+        return None
+    if any(c.isspace() for c in value):
+        return None
+    return value
 
 def extract_mp3_url(description: str) -> str | None:
-    unescaped = unescape(description)
-    match = re.search(r'<audio[^>]+src=["\']?([^"\'>\s]+\.mp3)', unescaped, re.IGNORECASE)
-    if match:
+    # Fast path: plain <audio src="...mp3"> markup with no entities to unescape
+    mp3_path = find_audio_src(description)
+    if not mp3_path:
+        # Entities can hide markup or attribute quotes from the regex, so unescape
+        # the whole description first, but only when it contains any
+        if '&' in description:
+            description = unescape(description)
+        match = MP3_URL_RE.search(description)
+        if not match:
+            return None
         mp3_path = match.group(1)
-        if mp3_path.startswith('/'):
-            return f"{BASE_URL}{mp3_path}"
-        return mp3_path
-    return None
+
+    if mp3_path.startswith('/'):
+        return f"{BASE_URL}{mp3_path}"
+    return mp3_path
 
 def fix_relative_urls(html_content: str) -> str:
     """Prepends BASE_URL to relative src and href attributes."""
-    if not html_content:
+    # Most descriptions have no relative URLs; two str scans beat a regex pass
+    if not html_content or ('="/' not in html_content and "='/" not in html_content):
         return html_content
-    pattern = r'(src|href)=["\']/(?!/)([^"\']+)["\']'
-    replacement = rf'\1="{BASE_URL}/\2"'
-    return re.sub(pattern, replacement, html_content)
+    return RELATIVE_URL_RE.sub(RELATIVE_URL_REPLACEMENT, html_content)
 
 def get_mp3_size(url: str) -> int:
     try:
-        request = urllib.request.Request(url, method='HEAD')
-        with urllib.request.urlopen(request, timeout=30) as response:
-            content_length = response.headers.get('Content-Length')
-            if content_length:
-                return int(content_length)
+        content_length = fetch_headers(url, method='HEAD').get('Content-Length')
+        if content_length:
+            return int(content_length)
+    except Exception:
+        pass
+    # Some CDNs block or mangle HEAD; fall back to a single-byte ranged GET
+    try:
+        content_range = fetch_headers(url, headers={'Range': 'bytes=0-0'}).get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
     except Exception:
         pass
     return 0
 
+def load_size_cache(path: str) -> dict[str, int]:
+    """Reads the mp3_url -> size cache, returning an empty dict if unusable."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    # Drop hand-edited or corrupt entries rather than failing the whole build
+    return {
+        url: size for url, size in cache.items()
+        if isinstance(url, str) and type(size) is int and size > 0  # bool is an int subclass
+    }
+
+def save_size_cache(path: str, cache: dict[str, int]) -> None:
+    """Atomically writes the cache, keeping only the most recently used entries."""
+    entries = list(cache.items())[-SIZE_CACHE_MAX_ENTRIES:]
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(entries), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: could not write size cache: {e}", file=sys.stderr)
+
 def format_duration(file_size_bytes: int) -> str:
     """Estimates duration in HH:MM:SS based on a fixed bitrate."""
     if file_size_bytes <= 0:
         return "00:00"
     
-    # Calculation: (Bytes * 8 bits) / Bits per second
-    total_seconds = int(file_size_bytes * 8 / BITRATE_BPS)
+    # Calculation: (Bytes * 8 bits) // Bits per second, kept in integers
+    total_seconds = file_size_bytes * 8 // BITRATE_BPS
     
+    # Episodes are usually a few minutes long, so skip the hours split
+    if total_seconds < 3600:
+        minutes, seconds = divmod(total_seconds, 60)
+        return f"{minutes:02}:{seconds:02}"
+
     hours, remainder = divmod(total_seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
-    
-    if hours > 0:
-        return f"{hours:02}:{minutes:02}:{seconds:02}"
-    return f"{minutes:02}:{seconds:02}"
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-def transform_feed(source_xml: str) -> str:
-    # Remove duplicate namespace declarations to keep the XML clean
-    source_xml = re.sub(r'(\s+xmlns:itunes="[^"]*")(\s+xmlns:itunes="[^"]*")+', r'\1', source_xml)
+def prepare_item(item: ET.Element) -> str | None:
+    """Fixes relative URLs in the item's description and returns its MP3 URL."""
+    description_elem = item.find('description')
+    if description_elem is None or not description_elem.text:
+        return None
 
+    # 1. Update relative URLs in description
+    description_elem.text = fix_relative_urls(description_elem.text)
+
+    # 2. Extract MP3 for enclosure
+    return extract_mp3_url(description_elem.text)
+
+def transform_feed(source: BinaryIO, skip_size: bool = False, default_duration: str = "00:00",
+                   cache_path: str | None = SIZE_CACHE_PATH) -> ET.Element:
     for prefix, uri in NAMESPACES.items():
         ET.register_namespace(prefix, uri)
 
-    root = ET.fromstring(source_xml)
-    channel = root.find('channel')
+    # Stream-parse so items without audio are dropped as soon as they are read
+    root = channel = None
+    in_channel = False
+    episodes = []
+    depth = 0
+    for event, elem in iter_feed_events(source):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+            elif channel is None and depth == CHANNEL_DEPTH and elem.tag == 'channel':
+                channel = elem
+                in_channel = True
+            continue
+
+        if elem is channel:
+            in_channel = False
+        elif in_channel and depth == ITEM_DEPTH and elem.tag == 'item':
+            mp3_url = prepare_item(elem)
+            if mp3_url:
+                episodes.append((elem, mp3_url))
+            else:
+                channel.remove(elem)
+        depth -= 1
 
     if channel is None:
         print("Error: No channel element found.", file=sys.stderr)
         sys.exit(1)
 
-    itunes_ns = NAMESPACES['itunes']
-
     # Set channel-level iTunes metadata
     tags = {
-        'author': "NHK Easier",
-        'summary': "Audio version of NHK Easier articles",
-        'explicit': "no"
+        ITUNES_AUTHOR: "NHK Easier",
+        ITUNES_SUMMARY: "Audio version of NHK Easier articles",
+        ITUNES_EXPLICIT: "no"
     }
+    # One pass over the children instead of a find() scan per tag
+    existing = {child.tag for child in channel}
     for tag, value in tags.items():
-        if channel.find(f'{{{itunes_ns}}}{tag}') is None:
-            ET.SubElement(channel, f'{{{itunes_ns}}}{tag}').text = value
+        if tag not in existing:
+            ET.SubElement(channel, tag).text = value
             
-    if channel.find(f'{{{itunes_ns}}}category') is None:
-        category = ET.SubElement(channel, f'{{{itunes_ns}}}category')
+    if ITUNES_CATEGORY not in existing:
+        category = ET.SubElement(channel, ITUNES_CATEGORY)
         category.set('text', 'News')
 
-    items_to_remove = []
-    for item in channel.findall('item'):
-        description_elem = item.find('description')
-        if description_elem is None or not description_elem.text:
-            items_to_remove.append(item)
-            continue
+    if skip_size:
+        file_sizes = [0] * len(episodes)
+    else:
+        size_cache = load_size_cache(cache_path) if cache_path else {}
+        missing = list(dict.fromkeys(
+            mp3_url for _, mp3_url in episodes if mp3_url not in size_cache
+        ))
+
+        # Fetch uncached MP3 sizes concurrently; the HEAD requests are network-bound
+        if missing:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                fetched = dict(zip(missing, executor.map(get_mp3_size, missing)))
+        else:
+            fetched = {}
 
-        # 1. Update relative URLs in description
-        description_elem.text = fix_relative_urls(description_elem.text)
+        file_sizes = []
+        for _, mp3_url in episodes:
+            file_size = size_cache.pop(mp3_url, None) or fetched.get(mp3_url, 0)
+            if file_size > 0:
+                # Re-insert so the dict order tracks recency for trimming
+                size_cache[mp3_url] = file_size
+            file_sizes.append(file_size)
 
-        # 2. Extract MP3 for enclosure
-        mp3_url = extract_mp3_url(description_elem.text)
-        if not mp3_url:
-            items_to_remove.append(item)
-            continue
+        if cache_path:
+            save_size_cache(cache_path, size_cache)
 
-        file_size = get_mp3_size(mp3_url)
+    for (item, mp3_url), file_size in zip(episodes, file_sizes):
+        existing = {child.tag for child in item}
 
         # 3. Handle Enclosure
-        enclosure = item.find('enclosure')
-        if enclosure is None:
-            enclosure = ET.SubElement(item, 'enclosure')
-            enclosure.set('url', mp3_url)
-            enclosure.set('type', 'audio/mpeg')
-            enclosure.set('length', str(file_size))
+        if 'enclosure' not in existing:
+            ET.SubElement(item, 'enclosure', {
+                'url': mp3_url,
+                'type': 'audio/mpeg',
+                'length': str(file_size)
+            })
 
         # 4. Corrected itunes:duration (Fixed the namespace string!)
-        if item.find(f'{{{itunes_ns}}}duration') is None:
-            duration_text = format_duration(file_size)
-            ET.SubElement(item, f'{{{itunes_ns}}}duration').text = duration_text
+        if ITUNES_DURATION not in existing:
+            duration_text = format_duration(file_size) if file_size > 0 else default_duration
+            ET.SubElement(item, ITUNES_DURATION).text = duration_text
 
-    for item in items_to_remove:
-        channel.remove(item)
+    return root
 
-    # Return as string with XML declaration
-    return ET.tostring(root, encoding='unicode', xml_declaration=True)
+def write_feed(root: ET.Element, output: BinaryIO) -> None:
+    """Serializes the feed straight to a binary stream with an XML declaration."""
+    ET.ElementTree(root).write(output, encoding='utf-8', xml_declaration=True)
 
 def main():
     parser = argparse.ArgumentParser(description="NHK Easier Feed Transformer")
     parser.add_argument('--source-url', type=str, default=SOURCE_FEED_URL)
     parser.add_argument('--output-file', type=str)
+    parser.add_argument('--skip-size', action='store_true',
+                        help="Don't fetch MP3 sizes; write length=0 and the default duration")
+    parser.add_argument('--default-duration', type=str, default="00:00",
+                        help="itunes:duration used when the MP3 size is unknown")
+    parser.add_argument('--cache-file', type=str, default=SIZE_CACHE_PATH,
+                        help="JSON cache of MP3 sizes; pass an empty string to disable")
     args = parser.parse_args()
 
     try:
-        source_xml = fetch_feed(args.source_url)
-        transformed_xml = transform_feed(source_xml)
+        with fetch_feed(args.source_url) as source:
+            root = transform_feed(source, args.skip_size, args.default_duration,
+                                  args.cache_file or None)
 
         if args.output_file:
-            with open(args.output_file, 'w', encoding='utf-8') as f:
-                f.write(transformed_xml)
+            with open(args.output_file, 'wb') as f:
+                write_feed(root, f)
         else:
-            print(transformed_xml)
+            write_feed(root, sys.stdout.buffer)
+            sys.stdout.buffer.write(b'\n')
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)